@@ -15,25 +15,54 @@
 
 import certifi
 import configparser
+import functools
 import json
+import orjson
 import os
 import sys
 
+from datetime import datetime
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import Search
 
 
 # ## Declaring functions
-# We can define new functions at any point. In this case we decided to declare 'create_conn' function here at the begining because is a generic function. In fact we could create a separate module with this kind of general functions and import that module in every notebook we need to create an ES connection.
+# We can define new functions at any point. In this case we decided to declare 'ORJSONSerializer' class and 'create_conn' and 'msearch' functions here at the begining because they are generic code. In fact we could create a separate module with this kind of general functions and import that module in every notebook we need to create an ES connection.
 # 
 # Notice we are pointing to '../.settings' file to use same config as in plain script version of this code.
 
 # In[2]:
 
 
+class ORJSONSerializer(JSONSerializer):
+    """JSON serializer using orjson, much faster than json module when
+    parsing big responses.
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except ValueError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # Strings are already serialized
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode('utf-8')
+        except TypeError as e:
+            raise SerializationError(data, e)
+
+
+@functools.lru_cache(maxsize=1)
 def create_conn():
     """Creates an ES connection from ''.settings' file.
 
+    The connection is created only once and reused in subsequent calls.
+
     ''.settings' contents sample:
     [ElasticSearch]
 
@@ -57,18 +86,56 @@ def create_conn():
     connection = "https://" + user + ":" + password + "@" + host + ":" + port                 + "/" + path
 
     es_read = Elasticsearch([connection], use_ssl=True,
-                            verity_certs=True, ca_cert=certifi.where(),
+                            verify_certs=True, ca_certs=certifi.where(),
+                            http_compress=True, serializer=ORJSONSerializer(),
                             scroll='300m', timeout=1000)
 
     return es_read
 
 
+def msearch(es_conn, searches, index='git', preference=None,
+            request_cache=None, filter_path=None):
+    """Executes given search objects through a single request to ES Multi
+    Search API, returning their responses (as dicts) in the same order.
+    Responses can be trimmed using 'filter_path', given as a list of
+    paths within each of them.
+
+    Adding more searches to the list costs no extra round-trips. Given
+    'preference' and 'request_cache' are sent in each search header.
+    """
+    header = {'index': index}
+    if preference is not None:
+        header['preference'] = preference
+    if request_cache is not None:
+        header['request_cache'] = request_cache
+
+    body = []
+    for s in searches:
+        body.append(header)
+        body.append(s.to_dict())
+
+    if filter_path:
+        # Keep status and errors, so every search still gets its response
+        filter_path = ','.join('responses.' + path
+                               for path in filter_path + ['status', 'error'])
+
+    result = es_conn.msearch(body=body, filter_path=filter_path)
+    responses = result['responses']
+    for response in responses:
+        if 'error' in response:
+            raise RuntimeError("search failed: %s" % response['error'])
+
+    return responses
+
+
 # ## Querying ES
 # Following code creates an ES connection and executes the query to get, for each author, first and last commit dates. 
 # 
-# In order to get unique authors, a bucket is created using 'author_uuid' field.
+# In order to get unique authors, a bucket is created using 'author_uuid' field. Buckets are retrieved using a composite aggregation, so we get them in pages of 1000 authors instead of asking ES for all of them at once.
 # 
 # Notice that a filter is applied to get data for whole years. Thus, we exclude data for current year.
+# 
+# As data for past years doesn't change, authors data is saved to '../.cache' folder once retrieved. Following executions during the same year load it from there instead of querying ES. Just remove that folder to get fresh data.
 
 # In[3]:
 
@@ -76,31 +143,74 @@ def create_conn():
 """Query ES to get first and last commit of each author together with
 some extra info like .
 """
-es_conn = create_conn()
-
-# Create search object
-s = Search(using=es_conn, index='git')
-
-# FILTER: retrieve commits before given year
-s = s.filter('range', grimoire_creation_date={'lt': 'now/y'})
-
-# Bucketize by uuid and get first and last commit (commit date is stored in
-# author_date field)
-s.aggs.bucket('authors', 'terms', field='author_uuid', size=10000000)     .metric('first', 'top_hits',
-            _source=['author_date', 'author_org_name', 'author_uuid', 'project'],
-            size=1,
-            sort=[{"author_date": {"order": "asc"}}]) \
-    .metric('last_commit', 'max', field='author_date')
-
-# Sort by commit date
-s = s.sort("author_date")
-
-result = s.execute()
+# Authors data only changes along with the filter date, so it is cached on
+# disk for each year and ES is only queried when there is no cached data
+year_start = '%d-01-01' % datetime.utcnow().year
+cache_path = os.path.join('..', '.cache', 'authors_%s.parquet' % year_start)
+cached = os.path.exists(cache_path)
+
+# Set only once every page has been retrieved, so partial results are never
+# cached
+complete = False
+result_buckets = []
+if not cached:
+    es_conn = create_conn()
+
+    # Create search object
+    s = Search(using=es_conn, index='git')
+
+    # FILTER: retrieve commits before given year. A concrete date is used
+    # instead of 'now/y' so ES can cache the filter between executions
+    s = s.filter('range', grimoire_creation_date={'lt': year_start,
+                                                  'format': 'yyyy-MM-dd'})
+
+    # Bucketize by uuid and get first and last commit (commit date is stored
+    # in author_date field). Org and project are those of the first commit,
+    # taken with top_metrics, so no documents need to be fetched for each
+    # bucket
+    s.aggs.bucket('authors', 'composite',
+                  sources=[{'uuid': {'terms': {'field': 'author_uuid'}}}],
+                  size=1000) \
+        .metric('first', 'min', field='author_date') \
+        .metric('last_commit', 'max', field='author_date') \
+        .metric('first_commit', 'top_metrics',
+                metrics=[{'field': 'author_org_name'}, {'field': 'project'}],
+                sort={'author_date': 'asc'})
+
+    # Only aggregations are needed, skip collecting hits
+    s = s.extra(size=0, track_total_hits=False)
+
+    # Response fields we read from 'authors' aggregation, anything else is not
+    # sent
+    author_paths = ['aggregations.authors.after_key'] + \
+        ['aggregations.authors.buckets.' + field
+         for field in ['key', 'first.value', 'last_commit.value',
+                       'first_commit.top.metrics']]
+
+    # Paginate over author buckets, 1000 at a time. Each page depends on the
+    # previous one, but any other search added to the msearch list would be
+    # sent along with it in the same request. Always hit the same shard copies,
+    # so their request cache can serve results from previous executions
+    while True:
+        result = msearch(es_conn, [s], preference='newcomers-notebook',
+                         request_cache=True, filter_path=author_paths)[0]
+        # Filtered responses may omit empty results
+        authors = result.get('aggregations', {}).get('authors', {})
+        if not authors.get('buckets'):
+            break
+
+        for bucket in authors['buckets']:
+            bucket['key'] = bucket['key']['uuid']
+        result_buckets.extend(authors['buckets'])
+
+        s.aggs['authors'].after = authors['after_key']
+
+    complete = True
 
 
 # # Print results
 # 
-# From here, we can start playing with the data, but first we can print those results to have a look at them.
+# From here, we can start playing with the data, but first we can print some of those results to have a look at them. There may be lots of authors, so printing all of them would take too long. When data comes from the cache there are no buckets to print, as ES was not queried.
 # 
 # Notice we can use variables from other cells that were executed previosly (look at numbers between square brackets if not sure about execution order).
 
@@ -109,9 +219,10 @@ result = s.execute()
 
 from pprint import pprint
 
-result_buckets = result.to_dict()['aggregations']['authors']['buckets']
-
-pprint(result_buckets)
+if cached:
+    print("Authors data loaded from cache (%s), ES was not queried" % cache_path)
+else:
+    pprint(result_buckets[:20])
 
 
 # ## Create Pandas dataframe
@@ -125,33 +236,55 @@ pprint(result_buckets)
 # In[5]:
 
 
+import numpy as np
 import pandas as pd
-from datetime import datetime
 
-# Get a dataframe with each author and their first commit
-buckets = []
-for bucket_author in result_buckets:
-    author = bucket_author['key']
-
-    first = bucket_author['first']['hits']['hits'][0]
-    first_commit = first['sort'][0]/1000
-    last_commit = bucket_author['last_commit']['value']/1000
-    org_name = first['_source']['author_org_name']
-    project = first['_source']['project']
-    
-    buckets.append({
-            'first_commit': datetime.utcfromtimestamp(first_commit),
-            'last_commit': datetime.utcfromtimestamp(last_commit),
-            'author': author,
-            'org': org_name,
-            'project': project
+if cached:
+    authors_df = pd.read_parquet(cache_path)
+else:
+    # Get a dataframe with each author and their first commit. Each column is
+    # filled in its own preallocated array, so no intermediate objects are
+    # created for each author
+    n = len(result_buckets)
+    author = np.empty(n, dtype=object)
+    first_ts = np.empty(n, dtype='int64')
+    last_ts = np.empty(n, dtype='int64')
+    org = np.empty(n, dtype=object)
+    project = np.empty(n, dtype=object)
+
+    for i, bucket_author in enumerate(result_buckets):
+        author[i] = bucket_author['key']
+        first_ts[i] = bucket_author['first']['value']
+        last_ts[i] = bucket_author['last_commit']['value']
+        # Filtered responses omit empty results, e.g. missing org or project
+        top = bucket_author.get('first_commit', {}).get('top')
+        metrics = top[0].get('metrics', {}) if top else {}
+        org[i] = metrics.get('author_org_name')
+        project[i] = metrics.get('project')
+
+    authors_df = pd.DataFrame({
+        'author': author,
+        'first_commit': pd.to_datetime(first_ts, unit='ms'),
+        'last_commit': pd.to_datetime(last_ts, unit='ms'),
+        'org': org,
+        'project': project
     })
-    
-authors_df = pd.DataFrame.from_records(buckets)
-authors_df.sort_values(by='first_commit', ascending=False,
-                        inplace=True)
 
-pprint(authors_df)
+    # Orgs and projects are a small set of repeated values, so store them as
+    # categories to save memory and speed up grouping by them
+    authors_df['org'] = authors_df['org'].astype('category')
+    authors_df['project'] = authors_df['project'].astype('category')
+
+    authors_df.sort_values(by='first_commit', ascending=False,
+                           inplace=True)
+
+    # Parquet keeps column types, including categories. Only complete, non
+    # empty results are cached, otherwise they would be reused all year long
+    if complete and n > 0:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        authors_df.to_parquet(cache_path)
+
+authors_df.head()
 
 
 # ## Newcomers per year
@@ -161,22 +294,23 @@ pprint(authors_df)
 
 
 # Group by year of first commit and project, counting number of authors
-first_df = authors_df.groupby([authors_df.first_commit.dt.year, authors_df.org])                        .agg({'author': pd.Series.nunique})
-first_df = first_df.reset_index()
-first_df.rename(columns={"first_commit": "year", "author": "newcomers"}, inplace=True)
-first_df = first_df.sort_values(by=['year', 'newcomers'], ascending=[False, False])
+first_df = authors_df.groupby([authors_df.first_commit.dt.year.rename('year'), 'org'],
+                              observed=True)['author'] \
+                     .nunique().rename('newcomers').reset_index()
+# Years and counts are small numbers, smaller types make further steps lighter
+first_df = first_df.astype({'year': 'int16', 'newcomers': 'int32'})
 
 
 # In[7]:
 
 
-# Get top 20 projects based on newcomers from 2008
-newcomers_df = pd.DataFrame()
-for year in first_df['year'].unique():
-    if year > 2008:
-        year_df = first_df.loc[first_df['year'] == year].head(20)
-        newcomers_df = pd.concat([newcomers_df, year_df])
-        
+# Get top 20 projects based on newcomers from 2008. Once sorted by count, the
+# first 20 rows of each year are the top ones
+newcomers_df = first_df.query('year > 2008') \
+    .sort_values(by=['year', 'newcomers'], ascending=[False, False]) \
+    .groupby('year', sort=False).head(20) \
+    .reset_index(drop=True)
+
 pprint(newcomers_df)
 
 
@@ -187,22 +321,23 @@ pprint(newcomers_df)
 
 
 # Group by year of last commit and project, counting number of authors
-last_df = authors_df.groupby([authors_df.last_commit.dt.year, authors_df.org])                        .agg({'author': pd.Series.nunique})
-last_df = last_df.reset_index()
-last_df.rename(columns={"last_commit": "year", "author": "leaving"}, inplace=True)
-last_df = last_df.sort_values(by=['year', 'leaving'], ascending=[False, False])
+last_df = authors_df.groupby([authors_df.last_commit.dt.year.rename('year'), 'org'],
+                             observed=True)['author'] \
+                    .nunique().rename('leaving').reset_index()
+# Same smaller types as for newcomers
+last_df = last_df.astype({'year': 'int16', 'leaving': 'int32'})
 
 
 # In[9]:
 
 
-# Get top 20 projects based on newcomers from 2008
-leaving_df = pd.DataFrame()
-for year in last_df['year'].unique():
-    if year > 2008:
-        year_df = last_df.loc[last_df['year'] == year].head(20)
-        leaving_df = pd.concat([leaving_df, year_df])
-        
+# Get top 20 projects based on people leaving from 2008. Once sorted by count, the
+# first 20 rows of each year are the top ones
+leaving_df = last_df.query('year > 2008') \
+    .sort_values(by=['year', 'leaving'], ascending=[False, False]) \
+    .groupby('year', sort=False).head(20) \
+    .reset_index(drop=True)
+
 pprint(leaving_df)
 
 
@@ -213,11 +348,16 @@ pprint(leaving_df)
 # In[10]:
 
 
-final_df = newcomers_df.merge(leaving_df, on=['year','org'], how='outer')
-final_df = final_df.fillna(0)
+# Align both dataframes on (year, org), leaving gaps where an org is only
+# among the top 20 for newcomers or for people leaving
+final_df = pd.concat([newcomers_df.set_index(['year', 'org']),
+                      leaving_df.set_index(['year', 'org'])], axis=1).reset_index()
+# Missing counts turn columns into floats, so fill and restore smaller types
+final_df = final_df.fillna({'newcomers': 0, 'leaving': 0}) \
+    .astype({'year': 'int16', 'newcomers': 'int32', 'leaving': 'int32'})
 final_df = final_df.sort_values(by=['year', 'org'], ascending=[False, False])
 
-pprint(final_df)
+final_df.head()
 
 
 # ## Plot a chart on Newcomers & People Leaving
@@ -245,24 +385,22 @@ plotly.offline.init_notebook_mode(connected=True)
 years = final_df.year.unique()
 orgs = final_df.org.unique()
 
+# Arrange data as year x org matrices, missing values mean nobody joined or
+# left. Filling them while reshaping keeps counts as integers. Each column
+# holds the values to plot for an org
+counts_df = final_df.set_index(['year', 'org'])
+pv_n = counts_df['newcomers'].unstack(fill_value=0) \
+    .reindex(index=years, columns=orgs, fill_value=0).values
+pv_l = counts_df['leaving'].unstack(fill_value=0) \
+    .reindex(index=years, columns=orgs, fill_value=0).values
+diff = pv_n - pv_l
+
 data = []
-for org in orgs:
-    newcomers = []
-    leaving = []
-    both = []
-    for year in years:
-        if year in final_df[final_df['org'] == org]['year'].unique():
-            n = final_df[(final_df['org'] == org) & (final_df['year'] == year)]['newcomers'].values[0]
-            l = final_df[(final_df['org'] == org) & (final_df['year'] == year)]['leaving'].values[0]
-            s = n - l
-        else:
-            n = 0
-            l = 0
-            s = 0
-        newcomers.append(n)
-        leaving.append(l)
-        both.append(s)
-        
+for j, org in enumerate(orgs):
+    newcomers = pv_n[:, j]
+    leaving = pv_l[:, j]
+    both = diff[:, j]
+
     data.append(
         go.Scatter(
             x = years,
@@ -23,15 +23,48 @@
 """Sample code to query ES for author first and last commit dates.
 """
 
+import argparse
+import asyncio
 import certifi
 import configparser
 import json
+import orjson
 import os
 import sys
 
-from elasticsearch import Elasticsearch
+from datetime import datetime
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_scan
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import Search
 
+# Response fields read from 'authors' aggregation, anything else is not sent
+AUTHOR_PATHS = ['aggregations.authors.after_key'] + \
+    ['aggregations.authors.buckets.' + field
+     for field in ['key', 'first.value', 'last_commit.value',
+                   'first_commit.top.metrics']]
+
+class ORJSONSerializer(JSONSerializer):
+    """JSON serializer using orjson, much faster than json module when
+    parsing big responses.
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except ValueError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # Strings are already serialized
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode('utf-8')
+        except TypeError as e:
+            raise SerializationError(data, e)
+
 def create_conn():
     """Creates an ES connection from ''.settings' file.
 
@@ -58,45 +91,188 @@ def create_conn():
     connection = "https://" + user + ":" + password + "@" + host + ":" + port \
                 + "/" + path
 
-    es_read = Elasticsearch([connection], use_ssl=True,
-                            verity_certs=True, ca_cert=certifi.where(),
-                            scroll='300m', timeout=1000)
+    es_read = AsyncElasticsearch([connection], use_ssl=True,
+                                 verify_certs=True, ca_certs=certifi.where(),
+                                 http_compress=True,
+                                 serializer=ORJSONSerializer(),
+                                 scroll='300m', timeout=1000)
 
     return es_read
 
-def main():
+def to_date(millis):
+    """Converts epoch milliseconds, as returned by date aggregations, to the
+    format dates are stored with in ES (e.g. '2017-03-01T10:25:03').
+    """
+    return datetime.utcfromtimestamp(millis / 1000).isoformat()
+
+async def msearch(es_conn, searches, index='git', preference=None,
+                  request_cache=None, filter_path=None):
+    """Executes given search objects through a single request to ES Multi
+    Search API, returning their responses (as dicts) in the same order.
+    Responses can be trimmed using 'filter_path', given as a list of
+    paths within each of them.
+
+    Adding more searches to the list costs no extra round-trips. Given
+    'preference' and 'request_cache' are sent in each search header.
+    """
+    header = {'index': index}
+    if preference is not None:
+        header['preference'] = preference
+    if request_cache is not None:
+        header['request_cache'] = request_cache
+
+    body = []
+    for s in searches:
+        body.append(header)
+        body.append(s.to_dict())
+
+    if filter_path:
+        # Keep status and errors, so every search still gets its response
+        filter_path = ','.join('responses.' + path
+                               for path in filter_path + ['status', 'error'])
+
+    result = await es_conn.msearch(body=body, filter_path=filter_path)
+    responses = result['responses']
+    for response in responses:
+        if 'error' in response:
+            raise RuntimeError("search failed: %s" % response['error'])
+
+    return responses
+
+async def get_authors(es_conn, s):
+    """Paginates over 'authors' composite aggregation from given search object
+    to get first and last commit dates of each author, together with org and
+    project of their first commit. Result has the same shape as the one from
+    'scan_authors': a dict by author uuid, with dates as stored in ES.
+
+    Next page is requested before processing current one, so ES computes it
+    while current buckets are turned into authors data.
+    """
+    def next_page():
+        # Always hit the same shard copies, so their request cache can serve
+        # results from previous executions
+        return asyncio.create_task(msearch(es_conn, [s],
+                                           preference='first-commit',
+                                           request_cache=True,
+                                           filter_path=AUTHOR_PATHS))
+
+    authors = {}
+    page = next_page()
+    while True:
+        result = (await page)[0]
+        # Filtered responses may omit empty results
+        aggs = result.get('aggregations', {}).get('authors', {})
+        if not aggs.get('buckets'):
+            break
+
+        # Next page starts after the last author returned. Let the request go
+        # out before processing current buckets
+        s.aggs['authors'].after = aggs['after_key']
+        page = next_page()
+        await asyncio.sleep(0)
+
+        for bucket in aggs['buckets']:
+            top = bucket.get('first_commit', {}).get('top')
+            metrics = top[0].get('metrics', {}) if top else {}
+            authors[bucket['key']['uuid']] = {
+                'first': to_date(bucket['first']['value']),
+                'last': to_date(bucket['last_commit']['value']),
+                'org': metrics.get('author_org_name'),
+                'project': metrics.get('project')
+            }
+
+    return authors
+
+async def scan_authors(es_conn, s):
+    """Scans commits matching given search object to get first and last
+    commit dates of each author, together with org and project of their
+    first commit.
+
+    Commits are streamed in '_doc' order and folded into a dict by author
+    uuid, so no buckets are built on ES side. This is the way to go when
+    per-commit data is needed instead of just first and last dates.
+    """
+    s = s.source(['author_uuid', 'author_date', 'author_org_name', 'project'])
+
+    authors = {}
+    async for hit in async_scan(es_conn, query=s.to_dict(), index='git',
+                                size=5000, request_timeout=1000,
+                                clear_scroll=True):
+        commit = hit['_source']
+        uuid = commit.get('author_uuid')
+        if uuid is None:
+            continue
+
+        date = commit['author_date']
+        author = authors.get(uuid)
+        if author is None or date < author['first']:
+            authors[uuid] = {
+                'first': date,
+                'last': author['last'] if author else date,
+                'org': commit.get('author_org_name'),
+                'project': commit.get('project')
+            }
+        elif date > author['last']:
+            author['last'] = date
+
+    return authors
+
+def author_aggs(s):
+    """Adds author aggregations to given search object.
+    """
+    # Bucketize by uuid and get first and last commit (commit date is stored in
+    # author_date field) together with org and project of the first commit,
+    # taken with top_metrics so no documents are fetched for each bucket.
+    # Composite aggregation is paginated to avoid building all author buckets
+    # at once
+    s.aggs.bucket('authors', 'composite',
+                  sources=[{'uuid': {'terms': {'field': 'author_uuid'}}}],
+                  size=1000) \
+        .metric('first', 'min', field='author_date') \
+        .metric('last_commit', 'max', field='author_date') \
+        .metric('first_commit', 'top_metrics',
+                metrics=[{'field': 'author_org_name'}, {'field': 'project'}],
+                sort={'author_date': 'asc'})
+
+    # Only aggregations are needed, skip collecting hits
+    return s.extra(size=0, track_total_hits=False)
+
+async def main():
     """Query ES to get first and last commit of each author together with
     some extra info like .
     """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scan', action='store_true',
+                        help="scan every commit instead of aggregating them")
+    args = parser.parse_args()
+
     es_conn = create_conn()
 
     # Create search object
-    s = Search(using=es_conn, index='git')
-
-    # FILTER: retrieve commits before given year
-    s = s.filter('range', grimoire_creation_date={'lt': 'now/y'})
+    s = Search(index='git')
 
-    # Bucketize by uuid and get first and last commit (commit date is stored in
-    # author_date field)
-    s.aggs.bucket('authors', 'terms', field='author_uuid', size=10000000) \
-        .metric('first', 'top_hits',
-                _source=['author_date', 'author_org_name', 'author_uuid', 'project'],
-                size=1,
-                sort=[{"author_date": {"order": "asc"}}]) \
-        .metric('last_commit', 'max', field='author_date')
+    # FILTER: retrieve commits before given year. A concrete date is used
+    # instead of 'now/y' so ES can cache the filter between executions
+    year_start = '%d-01-01' % datetime.utcnow().year
+    s = s.filter('range', grimoire_creation_date={'lt': year_start,
+                                                  'format': 'yyyy-MM-dd'})
 
-    # Sort by commit date
-    s = s.sort("author_date")
+    if args.scan:
+        pending = scan_authors(es_conn, s)
+    else:
+        pending = get_authors(es_conn, author_aggs(s))
 
-    #print(s.to_dict())
-    result = s.execute()
+    try:
+        result = await pending
+    finally:
+        await es_conn.close()
 
     # Print result
-    print(json.dumps(result.to_dict()['aggregations'], indent=2, sort_keys=True))
+    print(json.dumps(result, indent=2, sort_keys=True))
 
 if __name__ == '__main__':
     try:
-        main()
+        asyncio.run(main())
     except KeyboardInterrupt:
         s = "\n\nReceived Ctrl-C or other break signal. Exiting.\n"
         sys.stdout.write(s)